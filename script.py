@@ -1,11 +1,12 @@
 from __future__ import annotations
-import os, json, base64, hashlib, logging, sys
+import os, json, base64, hashlib, logging, re, sqlite3, sys
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
 
-from caldav import DAVClient
-from icalendar import Calendar
-from googleapiclient.discovery import build
-from google.oauth2.service_account import Credentials
+# Die schweren Abhängigkeiten (requests, caldav, icalendar, googleapiclient)
+# werden erst in den Funktionen importiert, die sie brauchen – ein No-Op-Lauf
+# (ICS-Export unverändert, 304) zahlt so keine halbe Sekunde Import-Zeit.
 
 # ---------- Konfiguration aus ENV ----------
 CALDAV_URL   = os.environ.get("CALDAV_URL", "").strip()
@@ -13,6 +14,9 @@ CALDAV_USER  = os.environ.get("CALDAV_USER", "").strip()
 CALDAV_PASS  = os.environ.get("CALDAV_PASS", "").strip()
 GOOGLE_CAL_ID = os.environ.get("GOOGLE_CAL_ID", "").strip()
 
+# Optional: direkter ICS-Export-Link statt CalDAV-REPORT (ETag-Shortcut)
+ICS_URL      = os.environ.get("ICS_URL", "").strip()
+
 # Zeitraum: wie weit in die Zukunft/ Vergangenheit schauen
 DAYS_AHEAD   = int(os.environ.get("DAYS_AHEAD", "14"))
 DAYS_PAST    = int(os.environ.get("DAYS_PAST", "1"))
@@ -23,6 +27,13 @@ GOOGLE_CREDENTIALS_JSON_B64 = os.environ.get("GOOGLE_CREDENTIALS_JSON_B64", "").
 
 LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
 
+# Lokaler Sync-Zustand (uid/lastmod/href plus Tokens) in SQLite
+SYNC_DB_FILE = os.environ.get("SYNC_DB_FILE", ".sync.db")
+
+# Alt-Dateien, die beim ersten Lauf in die SQLite-DB übernommen werden
+SYNC_TOKEN_FILE = os.environ.get("SYNC_TOKEN_FILE", ".gcal_sync_token")
+SYNC_CACHE_FILE = os.environ.get("SYNC_CACHE_FILE", ".sync_cache.json")
+
 # ---------- Logging ----------
 logging.basicConfig(
     level=getattr(logging, LOG_LEVEL, logging.INFO),
@@ -31,6 +42,8 @@ logging.basicConfig(
 log = logging.getLogger("iserv-sync")
 
 def load_google_credentials():
+    from google.oauth2.service_account import Credentials
+
     # 1) Base64-json (z. B. aus Docker Secret)
     if GOOGLE_CREDENTIALS_JSON_B64:
         try:
@@ -56,35 +69,112 @@ def load_google_credentials():
     log.error("Keine Google-Credentials gesetzt (GOOGLE_CREDENTIALS_JSON_B64 oder GOOGLE_CREDENTIALS_FILE).")
     sys.exit(2)
 
-def to_rfc3339(dt):
+@dataclass(slots=True)
+class Event:
+    # Geparstes VEVENT; slots statt dict → Attributzugriff ohne Hashing
+    # und weniger Allokationen in der Event-Schleife
+    uid: str
+    summary: str
+    description: str
+    start: dict
+    end: dict
+    lastmod: int
+    dtstart_day: int  # YYYYMMDD, für die fensterbezogene Löschmenge
+
+def to_rfc3339(dt, _utc=timezone.utc):
+    # _utc als Default-Argument gebunden: spart das LOAD_GLOBAL pro Aufruf;
+    # astimezone nur, wenn wirklich konvertiert werden muss (alloziert sonst
+    # unnötig ein neues datetime)
     if isinstance(dt, datetime):
         if dt.tzinfo is None:
-            dt = dt.replace(tzinfo=timezone.utc)
-        return dt.astimezone(timezone.utc).isoformat()
+            return dt.replace(tzinfo=_utc).isoformat()
+        if dt.tzinfo is _utc:
+            return dt.isoformat()
+        return dt.astimezone(_utc).isoformat()
     return None  # date-only separat behandeln
 
-def parse_vevents(ics_bytes: bytes):
-    cal = Calendar.from_ical(ics_bytes)
-    for comp in cal.walk("VEVENT"):
-        uid = str(comp.get("UID", "")).strip()
-        summary = str(comp.get("SUMMARY","")).strip()
-        description = str(comp.get("DESCRIPTION","")).strip()
+def iter_vevent_blocks(ics_bytes: bytes):
+    # VEVENT-Blöcke byteweise herausschneiden, statt den kompletten
+    # Kalenderbaum zu materialisieren – Peak-Speicher bleibt O(1 Event)
+    pos = 0
+    while True:
+        begin = ics_bytes.find(b"BEGIN:VEVENT", pos)
+        if begin < 0:
+            return
+        end = ics_bytes.find(b"END:VEVENT", begin)
+        if end < 0:
+            return
+        end += len(b"END:VEVENT")
+        yield ics_bytes[begin:end]
+        pos = end
+
+# Grober Byte-Scan vor dem teuren Parse: die 8-stelligen Datumsanteile von
+# DTSTART/DTEND reichen für den Fenstertest
+DTSTART_RE = re.compile(rb"DTSTART[^:\r\n]*:(\d{8})")
+DTEND_RE   = re.compile(rb"DTEND[^:\r\n]*:(\d{8})")
+
+def _outside_window(block: bytes, lo: int, hi: int) -> bool:
+    # lo/hi als YYYYMMDD-Ints; ohne DTSTART-Treffer wird normal geparst.
+    # Wiederholungs-Events nie vorfiltern: deren DTSTART/DTEND begrenzen nur
+    # das erste Vorkommen, spätere können trotzdem im Fenster liegen
+    if b"\nRRULE" in block or b"\nRDATE" in block:
+        return False
+    m = DTSTART_RE.search(block)
+    if not m:
+        return False
+    dtstart = int(m.group(1))
+    if dtstart > hi:
+        return True
+    m_end = DTEND_RE.search(block)
+    dtend = int(m_end.group(1)) if m_end else dtstart
+    return dtend < lo
+
+def parse_vevents(ics_bytes: bytes, window: tuple[int, int] | None = None):
+    # caldav liefert str, requests bytes – der Block-Splitter braucht bytes
+    if isinstance(ics_bytes, str):
+        ics_bytes = ics_bytes.encode("utf-8")
+    from icalendar import Calendar
+
+    for block in iter_vevent_blocks(ics_bytes):
+        if window is not None and _outside_window(block, *window):
+            continue
+        # Jeden Block einzeln in einen Minimal-Kalender verpacken und parsen;
+        # der Calendar-Baum wird nach dem yield sofort wieder freigegeben
+        cal = Calendar.from_ical(
+            b"BEGIN:VCALENDAR\r\nVERSION:2.0\r\n" + block + b"\r\nEND:VCALENDAR"
+        )
+        comp = cal.walk("VEVENT")[0]
+        # Lookups lokal binden und str()/strip() nur auf vorhandene Felder
+        # anwenden – spart pro Event einige Allokationen im heißen Pfad
+        get = comp.get
+        uid = get("UID")
+        uid = str(uid).strip() if uid else ""
+        summary = get("SUMMARY")
+        summary = str(summary).strip() if summary else ""
+        description = get("DESCRIPTION")
+        description = str(description).strip() if description else ""
         dtstart = comp.decoded("DTSTART")
         dtend   = comp.decoded("DTEND", fallback=None)
-        lastmod = comp.get("LAST-MODIFIED") or comp.get("DTSTAMP")
+        lastmod = get("LAST-MODIFIED") or get("DTSTAMP")
 
         if not uid:
+            # blake2b ist schneller als sha1 und als Dedup-Schlüssel völlig
+            # ausreichend; 16 Bytes halten den Property-Wert kurz
             raw = (summary + str(dtstart) + str(dtend)).encode()
-            uid = "fallback-" + hashlib.sha1(raw).hexdigest()
+            uid = "fallback-" + hashlib.blake2b(raw, digest_size=16).hexdigest()
 
+        # lastmod als Epochen-Sekunden: ein Int-Vergleich pro Event statt
+        # ISO-Formatierung plus String-Vergleich; 0 = kein Zeitstempel
         if lastmod:
             lm = lastmod.dt
             if isinstance(lm, datetime):
-                lastmod_iso = lm.astimezone(timezone.utc).isoformat()
+                if lm.tzinfo is None:
+                    lm = lm.replace(tzinfo=timezone.utc)
+                lastmod_epoch = int(lm.timestamp())
             else:
-                lastmod_iso = datetime(lm.year, lm.month, lm.day, tzinfo=timezone.utc).isoformat()
+                lastmod_epoch = int(datetime(lm.year, lm.month, lm.day, tzinfo=timezone.utc).timestamp())
         else:
-            lastmod_iso = None
+            lastmod_epoch = 0
 
         # payloads für Google
         if isinstance(dtstart, datetime):
@@ -103,75 +193,363 @@ def parse_vevents(ics_bytes: bytes):
             else:
                 end_payload = {"date": dtstart.isoformat()}
 
-        yield {
-            "uid": uid,
-            "summary": summary,
-            "description": description,
-            "start": start_payload,
-            "end": end_payload,
-            "lastmod": lastmod_iso,
-        }
+        yield Event(
+            uid=uid,
+            summary=summary,
+            description=description,
+            start=start_payload,
+            end=end_payload,
+            lastmod=lastmod_epoch,
+            dtstart_day=int(dtstart.strftime("%Y%m%d")),
+        )
+
+def open_sync_db():
+    # check_same_thread=False: CalDAV- und Google-Fetch laufen in Worker-
+    # Threads und schreiben nur disjunkte state-Schlüssel
+    conn = sqlite3.connect(SYNC_DB_FILE, check_same_thread=False)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS events"
+        "(uid TEXT PRIMARY KEY, lastmod INTEGER, href TEXT, dtstart INTEGER)"
+    )
+    cols = [row[1] for row in conn.execute("PRAGMA table_info(events)")]
+    if "dtstart" not in cols:
+        # Bestands-DB aus der Zeit vor der dtstart-Spalte nachziehen
+        conn.execute("ALTER TABLE events ADD COLUMN dtstart INTEGER")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_events_href ON events(href)")
+    conn.execute("CREATE TABLE IF NOT EXISTS state(key TEXT PRIMARY KEY, value TEXT)")
+    _migrate_json_cache(conn)
+    return conn
+
+def _migrate_json_cache(conn):
+    # Altbestand aus dem JSON-Cache und der Token-Datei einmalig übernehmen
+    if conn.execute("SELECT 1 FROM events LIMIT 1").fetchone() is not None:
+        return
+    try:
+        with open(SYNC_CACHE_FILE, "r", encoding="utf-8") as fh:
+            cache = json.load(fh)
+    except (OSError, ValueError):
+        cache = {}
+    if "events" not in cache:
+        cache = {"events": cache}
+    uid_to_href = {uid: href for href, uid in cache.get("hrefs", {}).items()}
+    for uid, lastmod in cache["events"].items():
+        if not isinstance(lastmod, int):
+            continue  # ISO-Altformat: beim nächsten Lauf ohnehin neu gepatcht
+        conn.execute(
+            "INSERT OR REPLACE INTO events(uid, lastmod, href) VALUES(?,?,?)",
+            (uid, lastmod, uid_to_href.get(uid)),
+        )
+    for key in ("caldav_sync_token", "ics_etag"):
+        if cache.get(key):
+            set_state(conn, key, cache[key])
+    try:
+        with open(SYNC_TOKEN_FILE, "r", encoding="utf-8") as fh:
+            token = fh.read().strip()
+        if token:
+            set_state(conn, "gcal_sync_token", token)
+    except OSError:
+        pass
+    conn.commit()
+
+def get_state(conn, key: str) -> str | None:
+    row = conn.execute("SELECT value FROM state WHERE key=?", (key,)).fetchone()
+    return row[0] if row else None
+
+def set_state(conn, key: str, value: str):
+    conn.execute("INSERT OR REPLACE INTO state(key, value) VALUES(?,?)", (key, value))
 
-def ensure_event(service, calendar_id: str, event, time_min_iso: str, time_max_iso: str):
-    # Suche nach existierendem Event via privateExtendedProperty
-    filters = [f"source=ISERV", f"uid={event['uid']}"]
+def del_state(conn, key: str):
+    conn.execute("DELETE FROM state WHERE key=?", (key,))
+
+def fetch_fresh_sync_token(service, calendar_id: str) -> str | None:
+    # nextSyncToken kommt nur auf der letzten Seite einer ungefilterten Liste;
+    # nur die Token-Felder abfragen, damit die Seiten leichtgewichtig bleiben.
+    page_token = None
+    while True:
+        resp = service.events().list(
+            calendarId=calendar_id,
+            singleEvents=True,
+            maxResults=2500,
+            pageToken=page_token,
+            fields="nextPageToken,nextSyncToken",
+        ).execute()
+        page_token = resp.get("nextPageToken")
+        if not page_token:
+            return resp.get("nextSyncToken")
+
+def build_http_session() -> requests.Session:
+    # Ein gemeinsamer Verbindungspool für CalDAV und ICS-Export: TCP- und
+    # TLS-Aufbau werden über alle Anfragen an denselben Host hinweg geteilt
+    import requests
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def fetch_ics_export(conn, session: requests.Session):
+    # Ein einzelner GET mit If-None-Match: antwortet der Server mit 304,
+    # ist der komplette Lauf ein No-Op (kein Payload, kein Parsen).
+    # Rückgabe: (Inhalt, neuer ETag); der ETag wird NICHT hier persistiert,
+    # sondern erst, wenn alle Mutationen des Laufs durch sind – sonst würde
+    # ein Abbruch die restlichen Änderungen hinter einem 304 verstecken.
+    headers = {}
+    etag = get_state(conn, "ics_etag")
+    if etag:
+        headers["If-None-Match"] = etag
+    resp = session.get(
+        ICS_URL,
+        auth=(CALDAV_USER, CALDAV_PASS),
+        headers=headers,
+        timeout=60,
+    )
+    if resp.status_code == 304:
+        return None, None
+    resp.raise_for_status()
+    return resp.content, resp.headers.get("ETag")
+
+def fetch_caldav_objects(calendar, start, end, conn):
+    # Mit RFC-6578-sync-token liefert der Server nur die seit dem letzten
+    # Lauf geänderten/gelöschten Objekte statt aller ICS-Bodies im Zeitraum.
+    # Rückgabe: (geänderte Objekte, hrefs gelöschter Objekte, voller Scan?,
+    # neues Token). Das Token wird NICHT hier persistiert, sondern erst nach
+    # erfolgreichem Lauf – ein früher Commit würde bei einem Abbruch die
+    # restlichen Deltas verschlucken.
+    token = get_state(conn, "caldav_sync_token")
+    if token:
+        try:
+            coll = calendar.objects_by_sync_token(sync_token=token, load_objects=True)
+            objs, gone = [], []
+            for obj in coll:
+                if getattr(obj, "data", None):
+                    objs.append(obj)
+                else:
+                    gone.append(str(obj.url))
+            log.debug("CalDAV inkrementell: %d geändert, %d gelöscht", len(objs), len(gone))
+            return objs, gone, False, str(coll.sync_token)
+        except Exception as e:
+            log.info("CalDAV sync-token nicht nutzbar (%s), voller Abruf", e)
+            del_state(conn, "caldav_sync_token")
+
+    objs = calendar.date_search(start=start, end=end)
+    new_token = None
+    try:
+        # Token für den nächsten Lauf besorgen (ohne ICS-Bodies zu laden)
+        coll = calendar.objects(load_objects=False)
+        new_token = str(coll.sync_token)
+    except Exception as e:
+        log.debug("Server unterstützt kein sync-collection REPORT: %s", e)
+    return objs, [], True, new_token
+
+def find_google_event(service, calendar_id: str, uid: str, index: dict):
+    # Für Tombstones: erst im Index schauen, sonst gezielte Einzelabfrage
+    # über den Kombi-Schlüssel (ein Filterpaar statt zwei)
+    g_event = index.get(uid)
+    if g_event is not None:
+        return g_event
+    resp = service.events().list(
+        calendarId=calendar_id,
+        privateExtendedProperty=[f"src_uid=ISERV:{uid}"],
+        maxResults=1,
+    ).execute()
+    items = resp.get("items", [])
+    if items:
+        return items[0]
+    # Altbestand ohne src_uid: Doppel-Filter als Fallback
     resp = service.events().list(
         calendarId=calendar_id,
-        timeMin=time_min_iso,
-        timeMax=time_max_iso,
-        singleEvents=True,
-        privateExtendedProperty=filters,
-        maxResults=2,
+        privateExtendedProperty=["source=ISERV", f"uid={uid}"],
+        maxResults=1,
     ).execute()
     items = resp.get("items", [])
+    return items[0] if items else None
+
+def load_google_index(service, calendar_id: str, time_min_iso: str, time_max_iso: str, conn):
+    # Google-Events einmalig holen und nach uid indizieren, statt pro VEVENT
+    # eine eigene list-Anfrage zu stellen. Liegt ein nextSyncToken vom letzten
+    # Lauf vor, liefert Google nur die seitdem geänderten Events (inkrementell);
+    # sonst (oder bei abgelaufenem Token, HTTP 410) voller Zeitraum-Scan.
+    from googleapiclient.errors import HttpError
+
+    index = {}
+    sync_token = get_state(conn, "gcal_sync_token")
+    new_token = None
 
-    if not items:
+    if sync_token:
+        try:
+            page_token = None
+            while True:
+                # syncToken erlaubt keine Filter; source=ISERV clientseitig
+                # prüfen. singleEvents muss zum Token-Abruf passen (gleiche
+                # Parameter wie beim Erstellen des Tokens, und der Index soll
+                # wie beim vollen Scan Instanzen statt Serien-Master führen)
+                resp = service.events().list(
+                    calendarId=calendar_id,
+                    syncToken=sync_token,
+                    singleEvents=True,
+                    maxResults=2500,
+                    pageToken=page_token,
+                ).execute()
+                for it in resp.get("items", []):
+                    priv = (it.get("extendedProperties") or {}).get("private", {})
+                    uid = priv.get("uid")
+                    if uid and priv.get("source") == "ISERV" and it.get("status") != "cancelled":
+                        index[uid] = it
+                page_token = resp.get("nextPageToken")
+                if not page_token:
+                    new_token = resp.get("nextSyncToken")
+                    break
+            if new_token:
+                set_state(conn, "gcal_sync_token", new_token)
+            log.debug("Google-Index inkrementell geladen: %d geänderte Events", len(index))
+            return index, False
+        except HttpError as e:
+            if e.resp.status != 410:
+                raise
+            log.info("Sync-Token abgelaufen, voller Abgleich")
+            index = {}
+
+    page_token = None
+    while True:
+        resp = service.events().list(
+            calendarId=calendar_id,
+            timeMin=time_min_iso,
+            timeMax=time_max_iso,
+            singleEvents=True,
+            privateExtendedProperty=["source=ISERV"],
+            maxResults=2500,
+            pageToken=page_token,
+        ).execute()
+        for it in resp.get("items", []):
+            uid = (it.get("extendedProperties") or {}).get("private", {}).get("uid")
+            if uid:
+                index[uid] = it
+        page_token = resp.get("nextPageToken")
+        if not page_token:
+            break
+
+    # Gefilterte Listen liefern kein nextSyncToken; separat nachholen
+    new_token = fetch_fresh_sync_token(service, calendar_id)
+    if new_token:
+        set_state(conn, "gcal_sync_token", new_token)
+    log.debug("Google-Index geladen: %d Events", len(index))
+    return index, True
+
+# Google erlaubt max. 50 Aufrufe pro Batch-Request
+BATCH_LIMIT = 50
+
+# Konstanten aus der Event-Schleife herausgezogen
+SYNC_SUFFIX = "\n\n[SYNC: ISERV]"
+
+def make_batch_callback(failed: set):
+    # request_id ist "laufnummer:uid" (die Laufnummer hält die IDs auch bei
+    # mehreren VEVENTs mit gleicher UID eindeutig); bei Fehlern wird die uid
+    # gesammelt, damit ihre Cache-Zeile vor dem Commit wieder entfernt wird
+    def _on_done(request_id, response, exception):
+        if exception is not None:
+            log.error("Batch-Aufruf %s fehlgeschlagen: %s", request_id, exception)
+            failed.add(request_id.split(":", 1)[1])
+        elif response:
+            log.info("Synced: %s  %s", response.get("id"), response.get("summary"))
+        else:
+            # delete liefert keinen Body
+            log.info("Deleted (Batch-Aufruf %s)", request_id)
+    return _on_done
+
+def _priv_lastmod_epoch(g_priv: dict) -> int:
+    try:
+        return int(g_priv.get("lastmod") or 0)
+    except ValueError:
+        # Altbestand im ISO-Format → gilt als geändert und wird einmal
+        # auf das Epochen-Format nachgepatcht
+        return -1
+
+def ensure_event(service, calendar_id: str, event, index: dict, index_full: bool):
+    # Existierendes Event per O(1)-Lookup im vorab geladenen Index suchen;
+    # liefert den insert/patch-Aufruf für den Batch oder None (unverändert)
+    g_event = index.get(event.uid)
+
+    if g_event is None and not index_full:
+        # Ein inkrementeller Index enthält nur Google-seitige Änderungen –
+        # ein quellseitig geändertes, Google-seitig unberührtes Event fehlt
+        # darin. Vor einem Insert gezielt nachschlagen, sonst Duplikate.
+        g_event = find_google_event(service, calendar_id, event.uid, index)
+
+    if g_event is None:
         body = {
-            "summary": event["summary"],
-            "description": (event["description"] or "") + "\n\n[SYNC: ISERV]",
-            "start": event["start"],
-            "end": event["end"],
+            "summary": event.summary,
+            "description": event.description + SYNC_SUFFIX,
+            "start": event.start,
+            "end": event.end,
             "extendedProperties": {
                 "private": {
                     "source": "ISERV",
-                    "uid": event["uid"],
-                    "lastmod": event["lastmod"] or "",
+                    "uid": event.uid,
+                    # Kombi-Schlüssel: gezielte Lookups brauchen damit nur
+                    # ein privateExtendedProperty-Filterpaar statt zwei
+                    "src_uid": f"ISERV:{event.uid}",
+                    "lastmod": str(event.lastmod),
                 }
             }
         }
-        created = service.events().insert(calendarId=calendar_id, body=body).execute()
-        log.info("Created: %s  %s", created.get("id"), event["summary"])
-        return
+        log.debug("Create queued: %s", event.summary)
+        return service.events().insert(calendarId=calendar_id, body=body)
 
-    g_event = items[0]
     g_priv = (g_event.get("extendedProperties") or {}).get("private", {})
-    if (event["lastmod"] or "") != g_priv.get("lastmod", ""):
+    if _priv_lastmod_epoch(g_priv) != event.lastmod:
         patch = {
-            "summary": event["summary"],
-            "description": (event["description"] or "") + "\n\n[SYNC: ISERV]",
-            "start": event["start"],
-            "end": event["end"],
-            "extendedProperties": {"private": {**g_priv, "lastmod": event["lastmod"] or ""}},
+            "summary": event.summary,
+            "description": event.description + SYNC_SUFFIX,
+            "start": event.start,
+            "end": event.end,
+            "extendedProperties": {"private": {
+                **g_priv,
+                "src_uid": f"ISERV:{event.uid}",
+                "lastmod": str(event.lastmod),
+            }},
         }
-        updated = service.events().patch(calendarId=calendar_id, eventId=g_event["id"], body=patch).execute()
-        log.info("Updated: %s  %s", updated.get("id"), event["summary"])
-    else:
-        log.debug("No change: %s  %s", g_event.get("id"), event["summary"])
+        log.debug("Update queued: %s  %s", g_event.get("id"), event.summary)
+        return service.events().patch(calendarId=calendar_id, eventId=g_event["id"], body=patch)
+
+    log.debug("No change: %s  %s", g_event.get("id"), event.summary)
+    return None
 
 def main():
     # Sanity Checks
-    missing = [k for k,v in {
-        "CALDAV_URL": CALDAV_URL,
+    required = {
         "CALDAV_USER": CALDAV_USER,
         "CALDAV_PASS": CALDAV_PASS,
         "GOOGLE_CAL_ID": GOOGLE_CAL_ID,
-    }.items() if not v]
+    }
+    if not ICS_URL:
+        required["CALDAV_URL"] = CALDAV_URL
+    missing = [k for k, v in required.items() if not v]
     if missing:
         log.error("Fehlende ENV Variablen: %s", ", ".join(missing))
         sys.exit(2)
 
+    conn = open_sync_db()
+    session = build_http_session()
+
+    content = None
+    new_etag = None
+    new_caldav_token = None
+    if ICS_URL:
+        # Direkter ICS-Export zuerst: bei 304 endet der Lauf, bevor
+        # überhaupt ein Google-Modul importiert oder aufgerufen wurde
+        content, new_etag = fetch_ics_export(conn, session)
+        if content is None:
+            log.info("ICS unverändert (ETag 304) – nichts zu tun")
+            conn.commit()
+            return
+
+    from googleapiclient.discovery import build
+
     creds = load_google_credentials()
-    service = build("calendar", "v3", credentials=creds, cache_discovery=False)
+    # static_discovery nutzt das im Client-Paket mitgelieferte Discovery-
+    # Dokument – spart den HTTPS-Roundtrip vor dem ersten echten Aufruf
+    service = build("calendar", "v3", credentials=creds, static_discovery=True)
 
     now = datetime.now(timezone.utc)
     start = now - timedelta(days=DAYS_PAST)
@@ -179,24 +557,174 @@ def main():
     time_min_iso = start.isoformat()
     time_max_iso = end.isoformat()
 
-    # CalDAV abrufen
-    client = DAVClient(url=CALDAV_URL, username=CALDAV_USER, password=CALDAV_PASS)
-    principal = client.principal()
-    calendars = principal.calendars()
-    if not calendars:
-        log.error("Kein CalDAV-Kalender gefunden (URL korrekt? Berechtigungen?)")
-        sys.exit(3)
-    calendar = calendars[0]
-
-    # Events als ICS im Zeitraum ziehen
-    ical_objs = calendar.date_search(start=start, end=end)
+    if ICS_URL:
+        index, google_full = load_google_index(service, GOOGLE_CAL_ID, time_min_iso, time_max_iso, conn)
+        sources = [(ICS_URL, content)]
+        gone_hrefs = []
+        source_full = True
+    else:
+        from caldav import DAVClient
+
+        # CalDAV abrufen; den gepoolten Session-Pool statt der vom Client
+        # selbst angelegten Session verwenden
+        client = DAVClient(url=CALDAV_URL, username=CALDAV_USER, password=CALDAV_PASS)
+        client.session = session
+        principal = client.principal()
+        calendars = principal.calendars()
+        if not calendars:
+            log.error("Kein CalDAV-Kalender gefunden (URL korrekt? Berechtigungen?)")
+            sys.exit(3)
+        calendar = calendars[0]
+
+        # CalDAV-Abruf und Google-Index sind unabhängige I/O-Ketten → parallel laden
+        with ThreadPoolExecutor(max_workers=2) as ex:
+            f_ical = ex.submit(fetch_caldav_objects, calendar, start, end, conn)
+            f_idx = ex.submit(load_google_index, service, GOOGLE_CAL_ID, time_min_iso, time_max_iso, conn)
+            ical_objs, gone_hrefs, source_full, new_caldav_token = f_ical.result()
+            index, google_full = f_idx.result()
+        sources = ((str(obj.url), obj.data) for obj in ical_objs)
+
+    # Mutationen sammeln und als Batch abschicken statt einzeln per HTTPS;
+    # commit pro Batch-Flush, damit ein Abbruch keinen Zustand verliert.
+    # Fehlgeschlagene Aufrufe fliegen vor dem Commit wieder aus dem Cache,
+    # sonst gälte ein nie angekommenes Event als synchronisiert.
+    failed = set()
+    failed_total = 0
+    # Für queued Löschungen: Zeilen-Backup, damit ein fehlgeschlagenes
+    # events().delete() seine lokal schon entfernte Zeile zurückbekommt
+    restore_rows = {}
+    on_done = make_batch_callback(failed)
+    batch = service.new_batch_http_request(callback=on_done)
+    pending = 0
+    seq = 0
+
+    def flush():
+        nonlocal batch, pending, failed_total
+        batch.execute()
+        if failed:
+            for uid in failed:
+                row = restore_rows.get(uid)
+                if row is not None:
+                    # Fehlgeschlagenes Löschen: Zeile wiederherstellen, der
+                    # nächste Abgleich versucht das Google-Event erneut
+                    conn.execute(
+                        "INSERT OR REPLACE INTO events(uid, lastmod, href, dtstart) VALUES(?,?,?,?)",
+                        row,
+                    )
+                else:
+                    conn.execute("DELETE FROM events WHERE uid=?", (uid,))
+            failed_total += len(failed)
+            failed.clear()
+        restore_rows.clear()
+        conn.commit()
+        batch = service.new_batch_http_request(callback=on_done)
+        pending = 0
+
+    def queue(req, uid):
+        nonlocal pending, seq
+        seq += 1
+        batch.add(req, request_id=f"{seq}:{uid}")
+        pending += 1
+        if pending >= BATCH_LIMIT:
+            flush()
+
+    # Fenster für den Byte-Prefilter, je einen Tag Puffer gegen
+    # Zeitzonen-Versatz der lokalen Datumsanteile
+    window = (
+        int((start - timedelta(days=1)).strftime("%Y%m%d")),
+        int((end + timedelta(days=1)).strftime("%Y%m%d")),
+    )
+
     total = 0
-    for obj in ical_objs:
-        for ev in parse_vevents(obj.data):
-            ensure_event(service, GOOGLE_CAL_ID, ev, time_min_iso, time_max_iso)
+    skipped = 0
+    seen = set()
+    for href, data in sources:
+        for ev in parse_vevents(data, window):
             total += 1
+            seen.add(ev.uid)
+            # Unverändert seit dem letzten Lauf → gar nicht erst anfassen
+            row = conn.execute(
+                "SELECT lastmod FROM events WHERE uid=?", (ev.uid,)
+            ).fetchone()
+            if ev.lastmod and row and row[0] == ev.lastmod:
+                skipped += 1
+                continue
+            req = ensure_event(service, GOOGLE_CAL_ID, ev, index, google_full)
+            # Upsert VOR queue(): der 50. Aufruf flusht sofort, und die
+            # Fehlerbereinigung im Flush muss diese Zeile entfernen können
+            conn.execute(
+                "INSERT OR REPLACE INTO events(uid, lastmod, href, dtstart) VALUES(?,?,?,?)",
+                (ev.uid, ev.lastmod, href, ev.dtstart_day),
+            )
+            if req is not None:
+                queue(req, ev.uid)
+
+    # Serverseitig gelöschte Objekte auch bei Google entfernen
+    deleted = 0
+    for href in gone_hrefs:
+        rows = conn.execute(
+            "SELECT uid, lastmod, href, dtstart FROM events WHERE href=?", (href,)
+        ).fetchall()
+        for row in rows:
+            uid = row[0]
+            conn.execute("DELETE FROM events WHERE uid=?", (uid,))
+            g_event = find_google_event(service, GOOGLE_CAL_ID, uid, index)
+            if g_event is not None:
+                restore_rows[uid] = row
+                queue(service.events().delete(calendarId=GOOGLE_CAL_ID, eventId=g_event["id"]), uid)
+                deleted += 1
+
+    # Quellseite vollständig gescannt → was dort fehlt, wurde gelöscht.
+    # Kandidaten kommen aus der lokalen DB, damit die Löschmenge auch bei
+    # inkrementellem Google-Index stimmt; die dtstart-Eingrenzung liegt einen
+    # Tag innerhalb des Abruf-Fensters, damit nur Events zur Debatte stehen,
+    # die der Quell-Abruf sicher geliefert hätte. Alt-Zeilen ohne dtstart und
+    # Wiederholungs-Events (Master-DTSTART vor dem Fenster) bleiben stehen.
+    if source_full:
+        inner_lo = int((start + timedelta(days=1)).strftime("%Y%m%d"))
+        inner_hi = int((end - timedelta(days=1)).strftime("%Y%m%d"))
+        stale = {
+            uid
+            for (uid,) in conn.execute(
+                "SELECT uid FROM events WHERE dtstart BETWEEN ? AND ?",
+                (inner_lo, inner_hi),
+            )
+            if uid not in seen
+        }
+        if google_full:
+            # Voller Google-Scan: zusätzlich ISERV-Events erwischen, die nie
+            # in der lokalen DB standen
+            stale |= index.keys() - seen
+        for uid in stale:
+            row = conn.execute(
+                "SELECT uid, lastmod, href, dtstart FROM events WHERE uid=?", (uid,)
+            ).fetchone()
+            conn.execute("DELETE FROM events WHERE uid=?", (uid,))
+            g_event = find_google_event(service, GOOGLE_CAL_ID, uid, index)
+            if g_event is not None:
+                if row is not None:
+                    restore_rows[uid] = row
+                queue(service.events().delete(calendarId=GOOGLE_CAL_ID, eventId=g_event["id"]), uid)
+                deleted += 1
+
+    if pending:
+        flush()
+    # Quell-Tokens erst festschreiben, wenn alle Mutationen angekommen sind;
+    # bei Fehlern bleibt das alte Token stehen, der nächste Lauf holt die
+    # Deltas erneut und versucht die fehlgeschlagenen Events noch einmal
+    if failed_total == 0:
+        if new_etag:
+            set_state(conn, "ics_etag", new_etag)
+        if new_caldav_token:
+            set_state(conn, "caldav_sync_token", new_caldav_token)
+    conn.commit()
+    conn.close()
+    log.debug("Per Cache übersprungen: %d, gelöscht: %d", skipped, deleted)
 
     log.info("Fertig. Verarbeitete Events: %d (Zeitraum %s → %s)", total, time_min_iso, time_max_iso)
+    if failed_total:
+        log.error("%d Batch-Aufrufe fehlgeschlagen – nächster Lauf versucht sie erneut", failed_total)
+        sys.exit(1)
 
 if __name__ == "__main__":
     try: